@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# Creates Proxmox VMs and waits for their guest agent IPs in a single process, reusing one
+# authenticated API session, instead of running create_vm.py and poll_for_ip.py per VM.
+
+DOCUMENTATION = r'''
+module: proxmox_vm
+short_description: Create Proxmox VMs and wait for their IPv4 addresses
+description:
+  - Runs create_vms_batch() from roles/provision_infra/files in-process on one ProxmoxAPI
+    session; VMs boot and are polled concurrently.
+  - Those files and module_utils/ must be on PYTHONPATH, and the interpreter must have proxmoxer installed.
+notes:
+  - Localhost only. The module imports create_vm.py, create_vms_batch.py and proxmox_common.py from the
+    repository checkout through PYTHONPATH, not through Ansible's module_utils, so AnsiballZ does not
+    bundle them; run it with delegate_to localhost (or connection local) on the controller.
+options:
+  api_host:
+    description: Proxmox API host, optionally as host:port (port defaults to 8006).
+    type: str
+    required: true
+  api_user:
+    description: API user, e.g. root@pam. Also the owner of the token when token auth is used.
+    type: str
+    required: true
+  api_password:
+    description: Password of api_user. Required unless api_token_name and api_token_value are given.
+    type: str
+  api_token_name:
+    description: Name of an API token of api_user, used instead of api_password.
+    type: str
+  api_token_value:
+    description: Secret of the API token named by api_token_name.
+    type: str
+  verify_ssl:
+    description: Verify the API's TLS certificate.
+    type: bool
+    default: false
+  node:
+    description: Proxmox node the VMs are created on.
+    type: str
+    required: true
+  vms:
+    description: One dict of create_vm.py settings (VM_NAME, VM_CORES, VM_MEMORY, ...) per VM.
+    type: list
+    elements: dict
+    required: true
+  max_workers:
+    description: Number of VMs created, started and polled concurrently.
+    type: int
+    default: 8
+  wait_for_ip:
+    description: Wait for each VM's guest agent to report an IPv4 address.
+    type: bool
+    default: true
+  poll_timeout:
+    description: Seconds to wait for each VM's IPv4 address.
+    type: int
+    default: 600
+  poll_interval:
+    description: Upper bound in seconds on the backoff between guest agent polls.
+    type: int
+    default: 60
+'''
+
+RETURN = r'''
+vms:
+  description: Per VM, in input order - name, vmid, status ('existing', 'started' or 'created'), ip and error if any.
+  type: list
+  elements: dict
+  returned: always
+'''
+
+import traceback
+
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+try:
+    from create_vm import CreateVMError, connect
+    from create_vms_batch import create_vms_batch, validate_specs
+    IMPORT_ERROR = None
+except ImportError:
+    IMPORT_ERROR = traceback.format_exc()
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            api_host=dict(type='str', required=True),
+            api_user=dict(type='str', required=True),
+            api_password=dict(type='str', no_log=True),
+            api_token_name=dict(type='str'),
+            api_token_value=dict(type='str', no_log=True),
+            verify_ssl=dict(type='bool', default=False),
+            node=dict(type='str', required=True),
+            vms=dict(type='list', elements='dict', required=True),
+            max_workers=dict(type='int', default=8),
+            wait_for_ip=dict(type='bool', default=True),
+            poll_timeout=dict(type='int', default=600),
+            poll_interval=dict(type='int', default=60),
+        ),
+        required_one_of=[('api_password', 'api_token_value')],
+        required_together=[('api_token_name', 'api_token_value')],
+    )
+    if IMPORT_ERROR:
+        module.fail_json(msg=missing_required_lib('proxmoxer and the provision_infra scripts'), exception=IMPORT_ERROR)
+
+    p = module.params
+    env = {
+        'PROXMOX_HOST': p['api_host'],
+        'PROXMOX_USER': p['api_user'],
+        'PROXMOX_VERIFY_SSL': str(p['verify_ssl']),
+        'PROXMOX_NODE': p['node'],
+    }
+    # create_vm.connect() prefers token auth when both token settings are present
+    for key, param in (('PROXMOX_PASSWORD', 'api_password'), ('PROXMOX_TOKEN_NAME', 'api_token_name'),
+                       ('PROXMOX_TOKEN_VALUE', 'api_token_value')):
+        if p[param]:
+            env[key] = p[param]
+
+    errors = validate_specs(p['vms'], env)
+    if errors:
+        module.fail_json(msg='; '.join(errors))
+
+    try:
+        proxmox = connect(env)
+    except CreateVMError as e:
+        module.fail_json(msg=str(e))
+
+    results = create_vms_batch(
+        p['vms'], env, proxmox,
+        max_workers=p['max_workers'],
+        wait_for_ip=p['wait_for_ip'],
+        timeout=p['poll_timeout'],
+        max_interval=p['poll_interval'],
+    )
+    changed = any(r.get('status') in ('started', 'created') for r in results)
+    errors = [f"{r['name']}: {r['error']}" for r in results if 'error' in r]
+    if errors:
+        module.fail_json(msg='; '.join(errors), changed=changed, vms=results)
+    module.exit_json(changed=changed, vms=results)
+
+
+if __name__ == '__main__':
+    main()
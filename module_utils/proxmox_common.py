@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Helpers shared by the Proxmox scripts in roles/*/files.
+# ansible.builtin.script copies a single file to a temp dir before running it,
+# so the tasks put this directory on PYTHONPATH to make it importable.
+import json
+import os
+import random
+import re
+import socket
+import stat
+import sys
+import tempfile
+import time
+
+import requests
+from proxmoxer import ProxmoxAPI, ResourceException
+from requests.adapters import HTTPAdapter
+
+# orjson is optional (listed in setup_localhost's requirements.txt); stdlib json is the fallback
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=str).decode()
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, default=str)
+
+    loads = json.loads
+
+# Network-level failures that are safe to retry; HTTP errors are classified by status code
+RETRYABLE = (requests.ConnectionError, requests.Timeout)
+# For non-idempotent calls (VM create, with retry_5xx=False): only failures where the request never
+# reached the server. After a read timeout or a 500 Proxmox may already have acted on it.
+NOT_SENT = (requests.ConnectTimeout,)
+
+
+class ProxmoxUnreachableError(Exception):
+    # Raised by _check_reachable(); refused is True when the port actively refused the connection
+    def __init__(self, message, refused=False):
+        super().__init__(message)
+        self.refused = refused
+
+
+def _is_retryable(e, retryable, retry_5xx):
+    # Proxmox reports transient failures (locks, busy daemons) as 5xx; 4xx means the request itself is wrong
+    if isinstance(e, ResourceException):
+        return retry_5xx and e.status_code >= 500
+    # A refused connect (pveproxy restarting) comes back at once and is worth another try;
+    # a probe that timed out already cost its full timeout
+    if isinstance(e, ProxmoxUnreachableError):
+        return e.refused
+    # SSLError subclasses ConnectionError, but a failed certificate check does not fix itself
+    if isinstance(e, requests.exceptions.SSLError):
+        return False
+    return isinstance(e, retryable)
+
+
+def retry(fn, *, retryable=RETRYABLE, retry_5xx=True, max_retries=3, base=1.0, cap=30, jitter=0.5):
+    # Call fn, retrying connection errors and HTTP 5xx with capped exponential backoff plus jitter.
+    # Anything else (4xx, auth failures, bad input) is re-raised immediately; retry_5xx=False
+    # re-raises 5xx too, for calls that must not be repeated once the server has seen them.
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e, retryable, retry_5xx):
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.uniform(0, jitter))
+            # stderr only: callers' stdout is parsed by the playbooks
+            print(f'Transient Proxmox API error ({e}); retry {attempt + 1}/{max_retries} in {delay:.1f}s', file=sys.stderr)
+            time.sleep(delay)
+
+
+def validate_env(env, required, optional=None):
+    # Check settings before any network I/O, reporting every missing name at once.
+    # Returns the required values plus the optional ones with their defaults applied.
+    missing = [key for key in required if not env.get(key)]
+    if missing:
+        raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+    values = {key: env[key] for key in required}
+    for key, default in (optional or {}).items():
+        values[key] = env.get(key, default)
+    return values
+
+
+def _check_reachable(host, port=8006, timeout=3):
+    # Plain TCP connect to the API port: an unreachable node fails here within seconds instead of
+    # hanging in ProxmoxAPI's TLS handshake and login. host may carry its own ':port'.
+    if host.count(':') == 1:
+        host, port = host.split(':')
+    try:
+        socket.create_connection((host, int(port)), timeout=timeout).close()
+    except OSError as e:
+        raise ProxmoxUnreachableError(f'Proxmox API at {host}:{port} is unreachable: {e}',
+                                      refused=isinstance(e, ConnectionRefusedError)) from e
+
+
+def connect_proxmox(host, user=None, password=None, token_name=None, token_value=None, verify_ssl=True, timeout=15):
+    # One authenticated API session; callers keep it for every call they make.
+    # timeout bounds every request made on the session, login included.
+    retry(lambda: _check_reachable(host))
+    if token_name and token_value:
+        proxmox = retry(lambda: ProxmoxAPI(host, user=user, token_name=token_name, token_value=token_value, verify_ssl=verify_ssl, timeout=timeout))
+    else:
+        proxmox = retry(lambda: ProxmoxAPI(host, user=user, password=password, verify_ssl=verify_ssl, timeout=timeout))
+    # proxmoxer keeps its requests.Session in _store; give it a pool large enough for
+    # create_vms_batch's worker threads so every call reuses a kept-alive TLS connection.
+    # Retries stay with retry(), not urllib3.
+    proxmox._store['session'].mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0))
+    return proxmox
+
+
+def _cache_dir():
+    # Private per-user directory: the cached listings decide which VMs count as existing and
+    # which storage gets the disks, so other users must not be able to plant or swap them
+    path = os.path.join(tempfile.gettempdir(), f'proxmox_cache_{os.getuid()}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'refusing to use cache directory {path}: not a private directory owned by this user')
+    return path
+
+
+def _cache_path(key):
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', '_'.join(str(k) for k in key))
+    return os.path.join(_cache_dir(), f'{name}.json')
+
+
+def cached_get(key, fn, ttl=30):
+    # Return fn() but reuse a result younger than ttl seconds from a JSON file keyed by key (a tuple).
+    # Ansible runs these scripts once per VM, so a short-lived file cache turns N identical
+    # listings into one.
+    try:
+        path = _cache_path(key)
+    except OSError:
+        # No usable cache directory: just make the call
+        return fn()
+    try:
+        if time.time() - os.path.getmtime(path) < ttl:
+            with open(path) as f:
+                return loads(f.read())
+    except (OSError, ValueError):
+        pass
+    data = fn()
+    tmp = None
+    try:
+        # Write to a fresh private temp file and rename so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(dumps(data))
+        os.replace(tmp, path)
+    except (OSError, TypeError):
+        if tmp:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return data
+
+
+def invalidate_cache(key):
+    try:
+        os.remove(_cache_path(key))
+    except OSError:
+        pass
@@ -1,176 +1,236 @@
 #!/usr/bin/env python3
 
+import functools
 import os
 import sys
+import time
 import logging
-from proxmoxer import ProxmoxAPI
+from proxmox_common import NOT_SENT, cached_get, connect_proxmox, invalidate_cache, retry, validate_env
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-def getenv(key, default=None):
-    val = os.environ.get(key)
-    return val if val is not None else default
+# All lookups go through an explicit env mapping (a snapshot of os.environ taken once in main),
+# so callers can supply their own configuration without touching os.environ.
+# key may be a single name or a tuple of alternative names; the first one that is set wins.
+def _keys(key):
+    return (key,) if isinstance(key, str) else key
 
-def getenv_int(key, default):
-    val = getenv(key, None)
-    # If an environment value exists, return its integer conversion
-    if val is not None:
-        try:
-            return int(val)
-        except Exception:
-            # fallback to default handling below
-            pass
+# Conversions are memoized: the same handful of strings is parsed for every VM in a batch
+@functools.lru_cache(maxsize=256)
+def _parse_int(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=256)
+def _parse_bool(val):
+    return val.lower() in ("1", "true", "yes", "on")
+
+def getenv(env, key, default=None):
+    for k in _keys(key):
+        val = env.get(k)
+        if val is not None:
+            return val
+    return default
+
+def getenv_int(env, key, default):
+    # Return the first integer-parseable value; unparseable values fall through to the default
+    for k in _keys(key):
+        val = env.get(k)
+        if val is not None and _parse_int(val) is not None:
+            return _parse_int(val)
     # If default is None, propagate None (used for optional values like VMID)
     if default is None:
         return None
     # Otherwise, try to convert default to int
-    try:
-        return int(default)
-    except Exception:
-        return None
+    return _parse_int(default)
 
-def getenv_bool(key, default=False):
-    val = getenv(key, None)
+def getenv_bool(env, key, default=False):
+    val = getenv(env, key, None)
     if val is None:
         return bool(default)
-    return val.lower() in ("1", "true", "yes", "on")
+    return _parse_bool(val)
 
-def main():
-    # Connection settings
-    host = getenv("PROXMOX_HOST")
-    if not host:
-        logging.error("PROXMOX_HOST must be set in the environment")
-        sys.exit(1)
+class CreateVMError(Exception):
+    # Raised by create_vm(); vmid is set when the VM exists but a later step failed
+    def __init__(self, message, vmid=None):
+        super().__init__(message)
+        self.vmid = vmid
 
-    # Support token auth or password auth
-    token_name = getenv("PROXMOX_TOKEN_NAME")
-    token_value = getenv("PROXMOX_TOKEN_VALUE")
+def validate(env):
+    # Offline checks of everything create_vm() needs, collected into one error so a bad
+    # configuration fails before any connection is attempted
+    problems = []
+    # Support token auth or password auth; PROXMOX_PASS is accepted for PROXMOX_PASSWORD.
+    # PROXMOX_USER is needed either way: an API token belongs to a user (user@realm!token)
+    required = ["PROXMOX_HOST", "PROXMOX_USER"]
+    if not (getenv(env, "PROXMOX_TOKEN_NAME") and getenv(env, "PROXMOX_TOKEN_VALUE")):
+        if not getenv(env, ("PROXMOX_PASSWORD", "PROXMOX_PASS")):
+            required.append("PROXMOX_PASSWORD")
+    try:
+        validate_env(env, required)
+    except ValueError as e:
+        problems.append(str(e))
+
+    # Same resolution as getenv_int(): empty values count as unset (Ansible's env lookup yields ''
+    # for unset variables) and the first parseable alternative wins, so a key is only reported
+    # when it is set and none of its alternatives parses
+    for key, positive in (("VMID", False), (("VM_CORES", "CORES"), True), ("SOCKETS", True),
+                          (("VM_MEMORY", "MEMORY"), True), (("VM_DISK_SIZE", "DISK_SIZE"), True)):
+        values = [env[k] for k in _keys(key) if env.get(k)]
+        if not values:
+            continue
+        val = getenv_int(env, key, None)
+        if val is None:
+            problems.append(f"{_keys(key)[0]} must be an integer, got {values[0]!r}")
+        elif positive and val <= 0:
+            problems.append(f"{_keys(key)[0]} must be a positive integer, got {val}")
+
+    if problems:
+        raise CreateVMError("; ".join(problems))
+
+def connect(env):
+    # Expects an env that has passed validate()
+    host = getenv(env, "PROXMOX_HOST")
+    token_name = getenv(env, "PROXMOX_TOKEN_NAME")
+    token_value = getenv(env, "PROXMOX_TOKEN_VALUE")
     # Accept PROXMOX_PASSWORD or PROXMOX_PASS
-    user = getenv("PROXMOX_USER")
-    password = getenv("PROXMOX_PASSWORD", getenv("PROXMOX_PASS"))
+    user = getenv(env, "PROXMOX_USER")
+    password = getenv(env, ("PROXMOX_PASSWORD", "PROXMOX_PASS"))
     # Verify SSL: default True (verify), can be set to false via env
-    verify_ssl = getenv_bool("PROXMOX_VERIFY_SSL", True)
+    verify_ssl = getenv_bool(env, "PROXMOX_VERIFY_SSL", True)
 
     try:
-        if token_name and token_value:
-            proxmox = ProxmoxAPI(host, token_name=token_name, token_value=token_value, verify_ssl=verify_ssl)
-        else:
-            if not user or not password:
-                logging.error("PROXMOX_USER and PROXMOX_PASSWORD (or PROXMOX_PASS) must be set if not using token auth")
-                sys.exit(1)
-            proxmox = ProxmoxAPI(host, user=user, password=password, verify_ssl=verify_ssl)
+        return connect_proxmox(host, user=user, password=password, token_name=token_name, token_value=token_value, verify_ssl=verify_ssl)
     except Exception as e:
-        logging.error(f"Failed to connect to Proxmox API: {e}")
-        sys.exit(1)
+        raise CreateVMError(f"Failed to connect to Proxmox API: {e}")
+
+def select_storage(proxmox, node, storage):
+    # Return storage if it can hold VM disks, otherwise the best fallback on the node
+    storages = retry(lambda: proxmox.nodes(node).storage.get())
+    # Normalize content and map storage name -> content string
+    storage_map = {s.get('storage'): str(s.get('content', '')).lower() for s in storages}
+    sel_content = storage_map.get(storage)
+    if sel_content and ('images' in sel_content or 'rootdir' in sel_content):
+        return storage
+    # Prefer local-lvm if available
+    if 'local-lvm' in storage_map and ('images' in storage_map['local-lvm'] or 'rootdir' in storage_map['local-lvm']):
+        return 'local-lvm'
+    for storage_name, content in storage_map.items():
+        if 'images' in content or 'rootdir' in content:
+            return storage_name
+    raise CreateVMError(f"No suitable storage found on node {node} that supports VM images. Available: {list(storage_map.keys())}")
+
+def list_vms(proxmox, node):
+    # Map VM name -> vmid on node. full=0: only the basic per-VM fields are needed, not the live
+    # status of running VMs
+    return {ev.get('name'): ev.get('vmid') for ev in retry(lambda: proxmox.nodes(node).qemu.get(full=0))}
+
+def create_vm(env, proxmox, vmids_by_name=None):
+    # Create (and by default start) the VM described by env on an existing API session.
+    # Returns (vmid, status, upid) where status is 'existing', 'started' or 'created' and upid
+    # is the create task (None for an existing VM).
+    # vmids_by_name is the node's list_vms() index; callers creating several VMs share one and
+    # create_vm() adds every VM it creates to it. Without one the node is listed afresh.
+    host = getenv(env, "PROXMOX_HOST")
 
     # Node and basic VM config with defaults mirroring the Proxmox UI wizard
-    node = getenv("PROXMOX_NODE", "pve")
-    name = getenv("VM_NAME", getenv("NAME", "proxmox-vm"))
-    vmid = getenv_int("VMID", None)
+    node = getenv(env, "PROXMOX_NODE", "pve")
+    name = getenv(env, ("VM_NAME", "NAME"), "proxmox-vm")
+    vmid = getenv_int(env, "VMID", None)
 
-    # If a VM with the same name already exists on the node, print and exit (do not create a duplicate)
-    try:
-        existing_vms = proxmox.nodes(node).qemu.get()
-        for ev in existing_vms:
-            if ev.get('name') == name:
-                existing_vmid = ev.get('vmid') or ev.get('vmid')
-                print(f"Existing VM {existing_vmid}...")
-                sys.exit(0)
-    except Exception:
-        # ignore errors querying existing VMs and continue with creation flow
-        pass
+    if getenv_bool(env, "PROXMOX_CACHE_BUST", False):
+        invalidate_cache(('storage', host, node, getenv(env, ("PROXMOX_STORAGE", "STORAGE"), "local-lvm")))
+
+    # If a VM with the same name already exists on the node, report it (do not create a duplicate)
+    if vmids_by_name is None:
+        try:
+            vmids_by_name = list_vms(proxmox, node)
+        except Exception:
+            # ignore errors querying existing VMs and continue with creation flow
+            vmids_by_name = {}
+    if name in vmids_by_name:
+        return vmids_by_name[name], 'existing', None
 
     # If no VMID provided, ask proxmox for nextid
     if vmid is None:
         try:
-            vmid = proxmox.cluster.nextid.get()
+            vmid = retry(lambda: proxmox.cluster.nextid.get())
         except Exception as e:
-            logging.error(f"Failed to get next VMID: {e}")
-            sys.exit(1)
+            raise CreateVMError(f"Failed to get next VMID: {e}")
 
     # Accept either VM_CORES/VM_MEMORY or CORES/MEMORY env names
-    cores = getenv_int("VM_CORES", getenv_int("CORES", 2))
-    sockets = getenv_int("SOCKETS", 1)
-    memory = getenv_int("VM_MEMORY", getenv_int("MEMORY", 2048))   # MiB
-    balloon = getenv_int("BALLOON", 0)
+    cores = getenv_int(env, ("VM_CORES", "CORES"), 2)
+    sockets = getenv_int(env, "SOCKETS", 1)
+    memory = getenv_int(env, ("VM_MEMORY", "MEMORY"), 2048)   # MiB
+    balloon = getenv_int(env, "BALLOON", 0)
 
     # Disk defaults - accept several env names
-    storage = getenv("PROXMOX_STORAGE", getenv("STORAGE", "local-lvm"))
-    disk_size = getenv_int("VM_DISK_SIZE", getenv_int("DISK_SIZE", 8))  # GiB
-    scsihw = getenv("SCSI_HW", "virtio-scsi-pci")
+    storage = getenv(env, ("PROXMOX_STORAGE", "STORAGE"), "local-lvm")
+    disk_size = getenv_int(env, ("VM_DISK_SIZE", "DISK_SIZE"), 8)  # GiB
+    scsihw = getenv(env, "SCSI_HW", "virtio-scsi-pci")
 
-    # Ensure selected storage supports VM images. If not, try to find a suitable fallback on the node.
+    # Ensure selected storage supports VM images. If not, use a suitable fallback on the node.
+    # The answer does not change between the VMs of a run, so it is cached per node and
+    # requested storage for five minutes (PROXMOX_CACHE_BUST=1 forces a fresh lookup).
     try:
-        storages = proxmox.nodes(node).storage.get()
-        # Normalize content and map storage name -> content string
-        storage_map = {s.get('storage'): str(s.get('content', '')).lower() for s in storages}
-        sel_content = storage_map.get(storage)
-        if not sel_content or ('images' not in sel_content and 'rootdir' not in sel_content):
-            # Prefer local-lvm if available
-            fallback = None
-            if 'local-lvm' in storage_map and ('images' in storage_map['local-lvm'] or 'rootdir' in storage_map['local-lvm']):
-                fallback = 'local-lvm'
-            else:
-                for name, content in storage_map.items():
-                    if 'images' in content or 'rootdir' in content:
-                        fallback = name
-                        break
-            if fallback:
-                logging.warning(f"Selected storage '{storage}' does not support VM images; using '{fallback}' instead")
-                storage = fallback
-            else:
-                logging.error(f"No suitable storage found on node {node} that supports VM images. Available: {list(storage_map.keys())}")
-                sys.exit(1)
+        selected = cached_get(('storage', host, node, storage), lambda: select_storage(proxmox, node, storage), ttl=300)
+    except CreateVMError:
+        raise
     except Exception:
         # If we cannot query storages, continue and let the API validate
-        pass
+        selected = storage
+    if selected != storage:
+        logging.warning(f"Selected storage '{storage}' does not support VM images; using '{selected}' instead")
+        storage = selected
 
     # Network defaults - build net0 from model and bridge if provided
-    net_model = getenv("VM_NET_MODEL", getenv("NET_MODEL", "virtio"))
-    net_bridge = getenv("VM_NET_BRIDGE", getenv("NET_BRIDGE", "vmbr0"))
-    net0 = getenv("NET0", f"{net_model},bridge={net_bridge}")
+    net_model = getenv(env, ("VM_NET_MODEL", "NET_MODEL"), "virtio")
+    net_bridge = getenv(env, ("VM_NET_BRIDGE", "NET_BRIDGE"), "vmbr0")
+    net0 = getenv(env, "NET0", f"{net_model},bridge={net_bridge}")
 
     # OS/type and boot
-    ostype = getenv("OSTYPE", "l26")      # Linux
+    ostype = getenv(env, "OSTYPE", "l26")      # Linux
     # Accept VM_ISO_IMAGE in multiple forms:
     # - full volume id like 'local:iso/ubuntu.iso' -> used as-is
     # - bare filename like 'ubuntu.iso' -> prefix with ISO_STORAGE (default 'local') and 'iso/'
-    iso_raw = getenv("VM_ISO_IMAGE", getenv("ISO"))
+    iso_raw = getenv(env, ("VM_ISO_IMAGE", "ISO"))
     iso = None
     if iso_raw:
         if ":" in iso_raw:
             iso = iso_raw
         else:
-            iso_storage = getenv("ISO_STORAGE", "local")
+            iso_storage = getenv(env, "ISO_STORAGE", "local")
             iso = f"{iso_storage}:iso/{iso_raw}"
 
     # Cloud-init defaults (used when using cloud-init disk)
     # Set DISABLE_CLOUDINIT to true to disable cloud-init entirely (default: true -> disabled)
-    disable_cloudinit = getenv_bool("DISABLE_CLOUDINIT", True)
+    disable_cloudinit = getenv_bool(env, "DISABLE_CLOUDINIT", True)
     # CLOUDINIT can still be used to explicitly enable cloud-init if DISABLE_CLOUDINIT is false
-    use_cloudinit = False if disable_cloudinit else getenv_bool("CLOUDINIT", True)
-    ciuser = getenv("CIUSER", "root")
-    cipassword = getenv("CIPASSWORD")
-    ipconfig0 = getenv("IPCONFIG0", getenv("VM_IP_ADDRESS", None))  # e.g. "ip=dhcp" or direct IP string
+    use_cloudinit = False if disable_cloudinit else getenv_bool(env, "CLOUDINIT", True)
+    ciuser = getenv(env, "CIUSER", "root")
+    cipassword = getenv(env, "CIPASSWORD")
+    ipconfig0 = getenv(env, ("IPCONFIG0", "VM_IP_ADDRESS"))  # e.g. "ip=dhcp" or direct IP string
 
     # Default to starting the VM so the playbook's changed_when matches
-    start_vm = getenv_bool("START_VM", True)
+    start_vm = getenv_bool(env, "START_VM", True)
     # Auto-start VM at boot: enabled by default, can be disabled via ONBOOT=0/false
-    onboot = getenv_bool("ONBOOT", True)
+    onboot = getenv_bool(env, "ONBOOT", True)
     # QEMU guest agent: enabled by default, can be disabled via QEMU_GUEST_AGENT=0/false
-    qga = getenv_bool("QEMU_GUEST_AGENT", True)
-    pool = getenv("POOL")
-    tags = getenv("TAGS")
+    qga = getenv_bool(env, "QEMU_GUEST_AGENT", True)
+    pool = getenv(env, "POOL")
+    tags = getenv(env, "TAGS")
 
     # GPU passthrough configuration check (before building params)
     # If GPU passthrough is enabled, we must use Q35 machine type
-    gpu_pci = getenv("GPU_PCI_ADDRESS")
+    gpu_pci = getenv(env, "GPU_PCI_ADDRESS")
     machine_type = "q35" if gpu_pci else None  # Q35 required for PCIe passthrough
 
     # CPU type configuration
     # Use 'host' to expose full physical CPU instruction set (including x86-64-v2 for modern software)
     # Default 'kvm64' only exposes baseline x86-64, causing issues with recent distroless images
-    cpu_type = getenv("VM_CPU_TYPE", "host")
+    cpu_type = getenv(env, "VM_CPU_TYPE", "host")
 
     # Build parameters for API call
     params = {
@@ -201,11 +261,11 @@ def main():
     if iso:
         params["ide2"] = f"{iso},media=cdrom"
         # If the user did not explicitly set BOOT, prefer the installed disk (scsi0) then CD (ide2)
-        if getenv("BOOT") is None:
+        if getenv(env, "BOOT") is None:
             params["boot"] = "order=scsi0;ide2"
             params["bootdisk"] = "scsi0"
         else:
-            params["boot"] = getenv("BOOT")
+            params["boot"] = getenv(env, "BOOT")
     else:
         # If no ISO and cloudinit enabled, add a cloud-init disk
         if use_cloudinit:
@@ -222,7 +282,7 @@ def main():
                     # attempt to put into ipconfig0 form (user may supply raw IP)
                     params["ipconfig0"] = f"ip={ipconfig0}"
         # Ensure VM will boot from the created disk by default if BOOT not specified
-        if getenv("BOOT") is None:
+        if getenv(env, "BOOT") is None:
             params["boot"] = "order=scsi0"
             params["bootdisk"] = "scsi0"
 
@@ -245,24 +305,69 @@ def main():
     logging.info(f"Creating VM {name} (vmid={vmid}) on node {node} with params: cores={cores}, memory={memory} MiB, disk={disk_size}GiB, net={net0}")
 
     try:
-        res = proxmox.nodes(node).qemu.post(**params)
-        logging.info(f"Create request accepted: {res}")
+        # Returns the create task's UPID as soon as the task is queued; callers wait on it.
+        # Creating is not idempotent (a repeat after a 500 such as "already exists" can never
+        # succeed), so only retry when the request cannot have reached the server
+        upid = retry(lambda: proxmox.nodes(node).qemu.post(**params), retryable=NOT_SENT, retry_5xx=False)
+        logging.info(f"Create request accepted: {upid}")
+        vmids_by_name[name] = int(vmid)
     except Exception as e:
-        logging.error(f"Failed to create VM: {e}")
-        sys.exit(1)
+        raise CreateVMError(f"Failed to create VM: {e}")
 
     # Optionally start VM
-    if start_vm:
+    if not start_vm:
+        return vmid, 'created', upid
+    wait_for_task(proxmox, node, upid, vmid)
+    start(proxmox, node, vmid)
+    return vmid, 'started', upid
+
+def wait_for_task(proxmox, node, upid, vmid, timeout=600, interval=2):
+    # Block until the task (e.g. the create, which holds the VM lock until it is done) has stopped.
+    # Raises CreateVMError if it fails or is still running after timeout seconds.
+    deadline = time.monotonic() + timeout
+    while True:
         try:
-            proxmox.nodes(node).qemu(vmid).status.start.post()
-            logging.info(f"VM {vmid} started")
-            # Print the exact string the playbook expects for changed_when and parsing
-            print(f"Starting VM {vmid}")
+            task = retry(lambda: proxmox.nodes(node).tasks(upid).status.get())
         except Exception as e:
-            logging.error(f"Failed to start VM {vmid}: {e}")
+            raise CreateVMError(f"Failed to query task {upid}: {e}", vmid=vmid)
+        if task.get("status") == "stopped":
+            exitstatus = task.get("exitstatus", "")
+            # "WARNINGS: N" means the task completed but logged warnings
+            if exitstatus.startswith("WARNINGS"):
+                logging.warning(f"Task {upid} finished with {exitstatus}")
+            elif exitstatus != "OK":
+                raise CreateVMError(f"Task {upid} failed: {exitstatus}", vmid=vmid)
+            return
+        if time.monotonic() >= deadline:
+            raise CreateVMError(f"Task {upid} still running after {timeout}s", vmid=vmid)
+        time.sleep(interval)
+
+def start(proxmox, node, vmid):
+    # Callers wait for the create task first, so the VM is no longer locked here
+    try:
+        retry(lambda: proxmox.nodes(node).qemu(vmid).status.start.post())
+        logging.info(f"VM {vmid} started")
+    except Exception as e:
+        raise CreateVMError(f"Failed to start VM {vmid}: {e}", vmid=vmid)
+
+def main():
+    env = dict(os.environ)
+    try:
+        validate(env)
+        proxmox = connect(env)
+        vmid, status, _ = create_vm(env, proxmox)
+    except CreateVMError as e:
+        logging.error(str(e))
+        if e.vmid is not None:
             # Still print vmid so downstream tasks can see something
-            print(vmid)
-            sys.exit(1)
+            print(e.vmid)
+        sys.exit(1)
+
+    # Print the exact strings the playbook expects for changed_when and parsing
+    if status == 'existing':
+        print(f"Existing VM {vmid}...")
+    elif status == 'started':
+        print(f"Starting VM {vmid}")
     else:
         print(vmid)
 
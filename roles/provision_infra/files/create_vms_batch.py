@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Create several VMs from one process and one API session, then wait for all their IPs concurrently.
+# VMS_JSON holds a list of create_vm.py settings dicts (VM_NAME, VM_CORES, ...); each entry overrides
+# the shared PROXMOX_* environment. Prints a JSON list with name/vmid/status/ip (or error) per VM.
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from create_vm import CreateVMError, connect, create_vm, getenv, getenv_bool, getenv_int, list_vms, start, validate, wait_for_task
+    from poll_for_ip import AgentDisabledError, fetch_guest_ip
+    from proxmox_common import dumps, loads
+except Exception as e:
+    print('Missing dependency:', e, file=sys.stderr)
+    sys.exit(10)
+
+# cluster/nextid is not a reservation, so VMID allocation + create must not interleave.
+# The create call itself is quick; booting and waiting for the guest agent is what runs in parallel.
+_create_lock = threading.Lock()
+
+
+def _spec_env(spec, base_env):
+    env = dict(base_env)
+    env.update({k: str(v) for k, v in spec.items() if v is not None})
+    return env
+
+
+def validate_specs(specs, base_env):
+    # Run create_vm's offline checks on every VM up front; returns one message per bad spec
+    errors = []
+    for spec in specs:
+        env = _spec_env(spec, base_env)
+        try:
+            validate(env)
+        except CreateVMError as e:
+            errors.append(f"{getenv(env, ('VM_NAME', 'NAME'), 'proxmox-vm')}: {e}")
+    return errors
+
+
+def provision_vm(spec, base_env, proxmox, vm_index):
+    # Create and start one VM; returns its result dict (name, vmid, status or error).
+    # vm_index maps node -> list_vms() index, listed once per node and kept current under the lock.
+    env = _spec_env(spec, base_env)
+    result = {'name': getenv(env, ('VM_NAME', 'NAME'), 'proxmox-vm')}
+    node = getenv(env, 'PROXMOX_NODE', 'pve')
+    try:
+        with _create_lock:
+            if node not in vm_index:
+                try:
+                    vm_index[node] = list_vms(proxmox, node)
+                except Exception:
+                    # Leave it to create_vm() to list (or not) on its own; retried by the next VM
+                    pass
+            vmid, status, upid = create_vm({**env, 'START_VM': 'false'}, proxmox, vm_index.get(node))
+        # Wait for the create task and start outside the lock, so the next VM's create is not
+        # queued behind this one
+        if status == 'created' and getenv_bool(env, 'START_VM', True):
+            wait_for_task(proxmox, node, upid, vmid)
+            start(proxmox, node, vmid)
+            status = 'started'
+    except CreateVMError as e:
+        result.update(vmid=e.vmid, error=str(e))
+        return result
+    result.update(vmid=int(vmid), status=status)
+    return result
+
+
+def poll_vm(result, spec, base_env, proxmox, timeout=600, max_interval=60):
+    # Wait for the guest agent of a provisioned VM to report an IPv4 address; updates result
+    node = getenv(_spec_env(spec, base_env), 'PROXMOX_NODE', 'pve')
+    vmid = result['vmid']
+    try:
+        ip = fetch_guest_ip(proxmox, node, vmid, timeout=timeout, max_interval=max_interval)
+    except AgentDisabledError as e:
+        result['error'] = f'QEMU guest agent is not enabled for VM {vmid}: {e}'
+        return result
+    result['ip'] = ip
+    if not ip:
+        result['error'] = f'VM {vmid} reported no IPv4 address within {timeout}s'
+    return result
+
+
+def create_vms_batch(specs, base_env, proxmox, max_workers=8, wait_for_ip=True, **poll_args):
+    # Two phases, so no VM's create waits behind another VM's (up to timeout long) IP poll:
+    # every VM is created and started first, then all of them are polled.
+    # proxmoxer's requests.Session is shared by all workers.
+    vm_index = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda spec: provision_vm(spec, base_env, proxmox, vm_index), specs))
+    if not wait_for_ip:
+        return results
+    pending = [(r, spec) for r, spec in zip(results, specs) if 'error' not in r]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda p: poll_vm(p[0], p[1], base_env, proxmox, **poll_args), pending))
+    return results
+
+
+def main():
+    env = dict(os.environ)
+    try:
+        specs = loads(env.get('VMS_JSON', ''))
+    except ValueError:
+        print('VMS_JSON must be set to a JSON list of VM specs', file=sys.stderr)
+        sys.exit(3)
+    if not isinstance(specs, list) or not all(isinstance(s, dict) for s in specs):
+        print('VMS_JSON must be a JSON list of objects', file=sys.stderr)
+        sys.exit(3)
+    errors = validate_specs(specs, env)
+    if errors:
+        print('; '.join(errors), file=sys.stderr)
+        sys.exit(3)
+
+    try:
+        proxmox = connect(env)
+    except CreateVMError as e:
+        print(e, file=sys.stderr)
+        sys.exit(4)
+
+    results = create_vms_batch(
+        specs, env, proxmox,
+        max_workers=getenv_int(env, 'MAX_WORKERS', 8),
+        wait_for_ip=getenv_bool(env, 'WAIT_FOR_IP', True),
+        timeout=getenv_int(env, 'POLL_TIMEOUT', 600),
+        max_interval=getenv_int(env, 'POLL_INTERVAL', 60),
+    )
+    print(dumps(results))
+    sys.exit(1 if any('error' in r for r in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
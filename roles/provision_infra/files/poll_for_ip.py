@@ -1,37 +1,60 @@
 #!/usr/bin/env python3
 import os
+import random
 import sys
 import time
 
 try:
-    from proxmoxer import ProxmoxAPI
+    from proxmoxer import ResourceException
+    from proxmox_common import connect_proxmox, dumps, validate_env
 except Exception as e:
     print('Missing dependency proxmoxer:', e, file=sys.stderr)
     sys.exit(10)
 
 
-def str2bool(v):
-    return str(v).lower() in ('1', 'true', 'yes')
+# Key spellings differ between guest agent / Proxmox versions; first non-empty wins
+IFACE_IP_KEYS = ('ip-addresses', 'ip_addresses', 'ip_addresses_v4')
+IP_KEYS = ('ip-address', 'ip_address', 'address', 'ip')
+TYPE_KEYS = ('ip-address-type', 'ip_address_type', 'type')
+# Link-local and loopback addresses are never the address the VM is reachable on
+SKIP_PREFIXES = ('169.254.', '127.')
+# Consecutive 'no guest agent configured' answers before giving up instead of waiting out the timeout
+AGENT_DISABLED_THRESHOLD = 3
 
 
-def connect_proxmox():
-    host = os.environ.get('PROXMOX_HOST')
-    user = os.environ.get('PROXMOX_USER')
-    password = os.environ.get('PROXMOX_PASSWORD')
-    verify_ssl = str2bool(os.environ.get('PROXMOX_VERIFY_SSL', 'false'))
+class AgentDisabledError(Exception):
+    pass
 
-    if not all([host, user, password]):
-        print('Missing PROXMOX_HOST/PROXMOX_USER/PROXMOX_PASSWORD environment variables', file=sys.stderr)
-        sys.exit(3)
 
+def _first(entry, keys):
+    return next(filter(None, (entry.get(k) for k in keys)), None)
+
+
+def str2bool(v):
+    return str(v).lower() in ('1', 'true', 'yes')
+
+
+def connect(config):
     try:
-        return ProxmoxAPI(host, user=user, password=password, verify_ssl=verify_ssl)
+        return connect_proxmox(config['PROXMOX_HOST'], user=config['PROXMOX_USER'], password=config['PROXMOX_PASSWORD'],
+                               verify_ssl=str2bool(config['PROXMOX_VERIFY_SSL']))
     except Exception as e:
         print('Failed to connect to Proxmox API:', e, file=sys.stderr)
         sys.exit(4)
 
 
 def _get_agent_network(node, proxmox, vmid):
+    # Cheap liveness probe first: while the agent is still starting there is no point
+    # fetching (and logging) the full interface list
+    try:
+        proxmox.nodes(node).qemu(vmid).agent('ping').post()
+    except ResourceException as e:
+        # 'not running' is normal while the guest boots; 'not configured' (agent=0) never recovers
+        if e.status_code == 500 and 'guest agent configured' in str(e).lower():
+            raise AgentDisabledError(str(e))
+        return None
+    except Exception:
+        return None
     # Try GET then POST; handle different response formats
     try:
         resp = proxmox.nodes(node).qemu(vmid).agent('network-get-interfaces').get()
@@ -60,59 +83,75 @@ def _parse_interfaces_for_ipv4(ifaces):
         candidates = [ifaces]
 
     for iface in candidates:
-        # ip address lists may be under different keys
-        ip_entries = iface.get('ip-addresses') or iface.get('ip_addresses') or iface.get('ip_addresses_v4') or []
-        for e in ip_entries:
-            # keys vary: try several
-            ip = e.get('ip-address') or e.get('ip_address') or e.get('address') or e.get('ip')
-            iptype = e.get('ip-address-type') or e.get('ip_address_type') or e.get('type') or ''
+        for e in _first(iface, IFACE_IP_KEYS) or []:
+            ip = _first(e, IP_KEYS)
             if not ip:
                 continue
-            # prefer IPv4, skip link-local
             ip_str = str(ip)
-            if str(iptype).lower().startswith('ipv4') and not (ip_str.startswith('169.254') or ip_str.startswith('127.0')):
-                return ip_str.strip()
-            if '.' in ip_str and not (ip_str.startswith('169.254') or ip_str.startswith('127.0')):
+            if ip_str.startswith(SKIP_PREFIXES):
+                continue
+            # prefer IPv4: either typed as such or dotted
+            if '.' in ip_str or str(_first(e, TYPE_KEYS) or '').lower().startswith('ipv4'):
                 return ip_str.strip()
     return None
 
 
-def fetch_guest_ip(proxmox, node, vmid, timeout=600, interval=60):
-    deadline = time.time() + timeout
+def fetch_guest_ip(proxmox, node, vmid, timeout=600, max_interval=60):
+    # Monotonic clock: an NTP step on the controller cannot shorten or stretch the wait
+    deadline = time.monotonic() + timeout
     poll = 0
-    while time.time() < deadline:
+    agent_disabled = 0
+    while time.monotonic() < deadline:
         poll += 1
         try:
             ifaces = _get_agent_network(node, proxmox, vmid)
-            # Debug: print network interfaces returned by the guest agent to stderr
-            try:
-                import json
-                print(f"DEBUG: vm {vmid} agent interfaces (poll {poll}): {json.dumps(ifaces, default=str)}", file=sys.stderr)
-            except Exception:
-                print(f"DEBUG: vm {vmid} agent interfaces (poll {poll}): {repr(ifaces)}", file=sys.stderr)
-
+            # Debug: print network interfaces returned by the guest agent to stderr. Only when someone
+            # is watching (a terminal) or POLL_DEBUG is set; under Ansible stderr just fills a log
+            if ifaces is not None and (sys.stderr.isatty() or os.environ.get('POLL_DEBUG')):
+                try:
+                    print(f"DEBUG: vm {vmid} agent interfaces (poll {poll}): {dumps(ifaces)}", file=sys.stderr)
+                except Exception:
+                    print(f"DEBUG: vm {vmid} agent interfaces (poll {poll}): {repr(ifaces)}", file=sys.stderr)
+
+            agent_disabled = 0
             ip = _parse_interfaces_for_ipv4(ifaces)
             if ip:
                 return ip
+        except AgentDisabledError:
+            agent_disabled += 1
+            if agent_disabled >= AGENT_DISABLED_THRESHOLD:
+                raise
         except Exception:
             # ignore transient errors (agent not ready yet)
             pass
-        time.sleep(interval)
+        # Back off exponentially (1, 2, 4, ... capped at max_interval) so a guest that boots
+        # quickly is picked up early, and never sleep past the deadline
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(max_interval, 2 ** (poll - 1) + random.random() * 0.5, remaining))
     return None
 
 
 def main():
     # Read configuration from environment variables
+    # Validate everything before the first API call
+    try:
+        config = validate_env(os.environ, ['PROXMOX_HOST', 'PROXMOX_USER', 'PROXMOX_PASSWORD', 'PROXMOX_NODE'],
+                              {'PROXMOX_VERIFY_SSL': 'false'})
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(3)
     vmid_env = os.environ.get('VM_ID') or os.environ.get('VMID')
-    node = os.environ.get('PROXMOX_NODE')
+    node = config['PROXMOX_NODE']
     try:
         timeout = int(os.environ.get('POLL_TIMEOUT', '600'))
     except ValueError:
         timeout = 600
     try:
-        interval = int(os.environ.get('POLL_INTERVAL', '60'))
+        max_interval = int(os.environ.get('POLL_INTERVAL', '60'))
     except ValueError:
-        interval = 60
+        max_interval = 60
 
     if not vmid_env:
         print('VM ID not specified via VM_ID or VMID environment variable', file=sys.stderr)
@@ -123,12 +162,16 @@ def main():
         print('Invalid VM ID specified in VM_ID/VMID', file=sys.stderr)
         sys.exit(3)
 
-    if not node:
-        print('Proxmox node not specified via PROXMOX_NODE env var', file=sys.stderr)
-        sys.exit(3)
-
-    proxmox = connect_proxmox()
-    ip = fetch_guest_ip(proxmox, node, vmid, timeout=timeout, interval=interval)
+    proxmox = connect(config)
+    try:
+        ip = fetch_guest_ip(proxmox, node, vmid, timeout=timeout, max_interval=max_interval)
+    except KeyboardInterrupt:
+        print(f'Interrupted while waiting for VM {vmid} IP', file=sys.stderr)
+        sys.exit(130)
+    except AgentDisabledError as e:
+        print(f'QEMU guest agent is not enabled for VM {vmid} ({e}); set agent=1 on the VM '
+              'and install qemu-guest-agent in the guest', file=sys.stderr)
+        sys.exit(6)
     if ip:
         print(ip)
         sys.exit(0)
@@ -1,6 +1,6 @@
 import os
 import sys
-from proxmoxer import ProxmoxAPI
+from proxmox_common import connect_proxmox, retry, validate_env
 
 # Get environment variables
 PROXMOX_HOST = os.environ.get("PROXMOX_HOST")
@@ -12,12 +12,14 @@ PROXMOX_STORAGE = os.environ.get("PROXMOX_STORAGE")
 IMAGE = os.environ.get("IMAGE")
 
 
-if not all([PROXMOX_HOST, PROXMOX_USER, PROXMOX_PASSWORD, PROXMOX_NODE, PROXMOX_STORAGE, IMAGE]):
-    print("Missing one or more required environment variables.")
+try:
+    validate_env(os.environ, ["PROXMOX_HOST", "PROXMOX_USER", "PROXMOX_PASSWORD", "PROXMOX_NODE", "PROXMOX_STORAGE", "IMAGE"])
+except ValueError as e:
+    print(e)
     sys.exit(1)
 
 # Connect to Proxmox API
-proxmox = ProxmoxAPI(
+proxmox = connect_proxmox(
     PROXMOX_HOST,
     user=PROXMOX_USER,
     password=PROXMOX_PASSWORD,
@@ -26,7 +28,7 @@ proxmox = ProxmoxAPI(
 
 # List content in the specified storage
 try:
-    storage_content = proxmox.nodes(PROXMOX_NODE).storage(PROXMOX_STORAGE).content.get()
+    storage_content = retry(lambda: proxmox.nodes(PROXMOX_NODE).storage(PROXMOX_STORAGE).content.get())
 except Exception as e:
     print(f"Error accessing storage: {e}")
     sys.exit(1)
@@ -3,12 +3,18 @@ import os
 import sys
 
 try:
-    from proxmoxer import ProxmoxAPI
+    from proxmox_common import connect_proxmox, validate_env
 except Exception as e:
-    print('Missing dependency proxmoxer:', e)
+    print('Missing dependency:', e)
     sys.exit(10)
 
 
+# proxmoxer streams large files through requests_toolbelt itself. After the body is sent Proxmox
+# copies the upload into storage before it answers, which can outlast connect_proxmox's default
+# request timeout, so this session gets a much longer one
+UPLOAD_TIMEOUT = 1800
+
+
 def str2bool(v):
     return str(v).lower() in ('1', 'true', 'yes')
 
@@ -20,18 +26,14 @@ PROXMOX_NODE = os.environ.get('PROXMOX_NODE')
 PROXMOX_STORAGE = os.environ.get('PROXMOX_STORAGE')
 IMAGE = os.environ.get('IMAGE')
 
-if not (PROXMOX_HOST and PROXMOX_USER and PROXMOX_PASSWORD and PROXMOX_NODE and PROXMOX_STORAGE and IMAGE):
-    print('Missing required environment variables')
+try:
+    validate_env(os.environ, ['PROXMOX_HOST', 'PROXMOX_USER', 'PROXMOX_PASSWORD', 'PROXMOX_NODE', 'PROXMOX_STORAGE', 'IMAGE'])
+except ValueError as e:
+    print(e)
     sys.exit(3)
 
 verify_ssl = str2bool(PROXMOX_VERIFY_SSL)
 
-try:
-    proxmox = ProxmoxAPI(PROXMOX_HOST, user=PROXMOX_USER, password=PROXMOX_PASSWORD, verify_ssl=verify_ssl)
-except Exception as e:
-    print('Failed to connect to Proxmox API:', e)
-    sys.exit(4)
-
 candidates = []
 # Also try relative to this script's directory (role files dir)
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -52,6 +54,15 @@ if not iso_path:
         print(' -', p)
     sys.exit(5)
 
+# Connect only once the inputs are known to be good
+try:
+    proxmox = connect_proxmox(PROXMOX_HOST, user=PROXMOX_USER, password=PROXMOX_PASSWORD, verify_ssl=verify_ssl,
+                              timeout=UPLOAD_TIMEOUT)
+except Exception as e:
+    print('Failed to connect to Proxmox API:', e)
+    sys.exit(4)
+
+# Not retried: a failure part-way would re-send the whole ISO
 try:
     with open(iso_path, 'rb') as f:
         print(f'Uploading {iso_path} to storage {PROXMOX_STORAGE} on node {PROXMOX_NODE}...')
@@ -1,6 +1,6 @@
 import ansible_runner
 import os 
-import shutil
+import subprocess
 from dotenv import load_dotenv
 import time
 
@@ -8,9 +8,12 @@ load_dotenv()
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 artifact_path = os.path.join(dir_path, 'artifacts')
+# Move the previous run's artifacts aside (a rename is O(1)) and delete them in the background
 try:
-    shutil.rmtree(artifact_path)
-except Exception as e:
+    old_artifact_path = f"{artifact_path}.old.{time.time()}"
+    os.rename(artifact_path, old_artifact_path)
+    subprocess.Popen(['rm', '-rf', old_artifact_path], start_new_session=True)
+except FileNotFoundError:
     pass
 
 start_time = time.time()